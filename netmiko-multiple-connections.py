@@ -1,36 +1,91 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import datetime as dt
+import io
+from itertools import islice
+from itertools import repeat
+import json
+import locale
 from logging import DEBUG
 from logging import Formatter
 from logging import getLogger
 from logging import StreamHandler
+import multiprocessing
 import os
+import socket
+import threading
 from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 import netmiko
+from netmiko.session_log import SessionLog
 from netmiko.ssh_autodetect import SSHDetect
 from netmiko.ssh_dispatcher import ConnectHandler
-from netmiko import utilities as netutil
 
 import ping3 as ping
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import icmplib
+except ImportError:
+    icmplib = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+except ImportError:
+    pv = None
+
 
 HOSTLIST = 'hostlist.csv'
 COMMANDLIST = 'commandlist.csv'
+READ_BUFFER = 1 << 16
+ARROW_THRESHOLD = 1 << 20
+ARROW_BLOCK_SIZE = 1 << 20
+MAX_WORKERS = 32
+PROCESS_THRESHOLD = 256
+PING_BEFORE_CONNECT = True
+KEEP_ALIVE = False
+PART_SUFFIX = '.part'
+
+JST = dt.timezone(dt.timedelta(hours=9))
+TIME_FMT = '%Y%m%d-%H%M%S'
+DEVTYPE_CACHE = os.path.expanduser('~/.netmiko_devtype_cache.json')
+
+LOG_FORMATTER = Formatter(
+    '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+    '%Y-%m-%d %H:%M:%S')
+RULER = '=' * 30
+FOOTER = '=' * 80
 
 ping.EXCEPTIONS = True
 
 
 class CSVOperator:
 
+    __slots__ = ()
+
     def read_hostlist(self, csv_file: str = None) -> List[Dict[str, str]]:
         if not csv_file:
             csv_file = HOSTLIST
 
         try:
-            with open(csv_file, 'r') as f:
+            if pv and os.path.getsize(csv_file) >= ARROW_THRESHOLD:
+                try:
+                    return self.read_hostlist_arrow(csv_file)
+                # arrow rejects short rows and undecodable bytes that DictReader copes with
+                except (pa.ArrowInvalid, UnicodeDecodeError):
+                    pass
+
+            with open(csv_file, 'r', buffering=READ_BUFFER, newline='') as f:
                 hostdict = csv.DictReader(f)
                 hostlist = list(hostdict)
                 return hostlist
@@ -38,15 +93,28 @@ class CSVOperator:
         except IOError:
             print(f'I/O error: {csv_file}\n')
 
-    def read_commandlist(self, csv_file: str = None) -> List[List[str]]:
+    def read_hostlist_arrow(self, csv_file: str) -> List[Dict[str, str]]:
+        # arrow assumes UTF-8; decode with the locale encoding open() uses on the csv module path
+        encoding = locale.getpreferredencoding(False)
+        # keep every column as str, like csv.DictReader does
+        with open(csv_file, 'r', encoding=encoding, newline='') as f:
+            header = next(csv.reader(f))
+        column_types = {name: pa.string() for name in header}
+        read_options = pv.ReadOptions(block_size=ARROW_BLOCK_SIZE, encoding=encoding)
+        table = pv.read_csv(csv_file,
+                            read_options=read_options,
+                            convert_options=pv.ConvertOptions(column_types=column_types))
+        return table.to_pylist()
+
+    def read_commandlist(self, csv_file: str = None) -> Tuple[str, ...]:
         if not csv_file:
             csv_file = COMMANDLIST
 
         try:
-            with open(csv_file, 'r') as f:
+            with open(csv_file, 'r', buffering=READ_BUFFER, newline='') as f:
                 csv_reader = csv.reader(f)
-                commandlist = list(csv_reader)
-                del commandlist[0]
+                # skip the header row lazily, without materializing the file
+                commandlist = tuple(row[0] for row in islice(csv_reader, 1, None) if row)
                 return commandlist
 
         except IOError:
@@ -55,49 +123,159 @@ class CSVOperator:
 
 class NetmikoOperator:
 
+    __slots__ = ('logger', 'devtypes')
+
+    devtype_lock = threading.Lock()
+    # connections kept open between multi_connections calls when keep_alive is set
+    connections: Dict[str, Callable] = {}
+    connections_lock = threading.Lock()
+
     def __init__(self) -> None:
         self.logger = self.setup_logger()
+        self.devtypes = self.load_devtypes()
 
     def setup_logger(self) -> Callable:
         logger = getLogger(__name__)
         logger.setLevel(DEBUG)
+        # every operator (and forked worker) shares one logger; configure it only once
+        if logger.handlers:
+            return logger
 
         sh = StreamHandler()
         sh.setLevel(DEBUG)
-        sh_formatter = Formatter(
-            '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
-            '%Y-%m-%d %H:%M:%S')
-        sh.setFormatter(sh_formatter)
+        sh.setFormatter(LOG_FORMATTER)
 
         logger.addHandler(sh)
         logger.propagate = False
         return logger
 
-    def connect_autodetect(self, hostinfo: Dict[str, str], loginfo: str) -> Callable:
+    def load_devtypes(self) -> Dict[str, str]:
+        try:
+            with open(DEVTYPE_CACHE, 'r') as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return {}
+
+    def save_devtype(self, host: str, device_type: str) -> None:
+        self.devtypes[host] = device_type
+        # threads share the lock, other processes are serialized by flock
+        with self.devtype_lock, open(DEVTYPE_CACHE, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                cache = json.load(f)
+            except ValueError:
+                cache = {}
+            cache[host] = device_type
+            f.seek(0)
+            f.truncate()
+            json.dump(cache, f, indent=2)
+
+    def detect_device_type(self, remote_device: Dict[str, str]) -> Optional[str]:
+        host = remote_device['host']
+        device_type = self.devtypes.get(host)
+        if device_type:
+            return device_type
+
+        detector = SSHDetect(**remote_device)
+        device_type = detector.autodetect()
+        if device_type:
+            self.save_devtype(host, device_type)
+        return device_type
+
+    def connect_autodetect(self, hostinfo: Dict[str, str], session_log: io.BufferedIOBase) -> Callable:
         remote_device = {'device_type': 'autodetect',
                          'host': hostinfo.get("host"),
                          'username': hostinfo.get("username"),
                          'password': hostinfo.get("password"),
-                         'secret': hostinfo.get("secret"),
-                         'session_log': loginfo}
-        detector = SSHDetect(**remote_device)
-        remote_device['device_type'] = detector.autodetect()
-        connection = ConnectHandler(**remote_device)
+                         'secret': hostinfo.get("secret")}
+        remote_device['device_type'] = (hostinfo.get("device_type")
+                                        or self.detect_device_type(remote_device))
+        # only the real session is logged; the autodetect probe would be truncated away anyway
+        connection = ConnectHandler(**remote_device, session_log=session_log)
+        self.set_nodelay(connection)
+        connection.enable()
         return connection
 
+    def set_nodelay(self, connection: Callable) -> None:
+        # commands are small writes waiting on a reply; don't let Nagle hold them back
+        transport = getattr(connection.remote_conn, 'get_transport', None)
+        sock = transport().sock if transport else None
+        if isinstance(sock, socket.socket):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_connection(self, hinfo: Dict[str, str], session_log: io.BufferedIOBase) -> Callable:
+        host = hinfo.get("host")
+        with self.connections_lock:
+            conn = self.connections.pop(host, None)
+
+        if conn and conn.is_alive():
+            # point the kept connection at this run's log file, masking secrets as netmiko does
+            no_log = {key: getattr(conn, key) for key in ('password', 'secret') if getattr(conn, key)}
+            conn.session_log = SessionLog(buffered_io=session_log, no_log=no_log)
+            return conn
+        if conn:
+            conn.disconnect()
+
+        return self.connect_autodetect(hinfo, session_log)
+
+    def release_connection(self, host: str, conn: Callable, keep_alive: bool) -> None:
+        if not keep_alive:
+            conn.disconnect()
+            return
+
+        # flush into this run's log file, which the caller closes; the next run attaches a new one
+        conn.session_log.close()
+        conn.session_log = None
+        with self.connections_lock:
+            # a host listed twice connects twice; don't orphan the one already kept
+            previous = self.connections.pop(host, None)
+            self.connections[host] = conn
+        if previous:
+            previous.disconnect()
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls.connections_lock:
+            connections = list(cls.connections.values())
+            cls.connections.clear()
+        for conn in connections:
+            conn.disconnect()
+
+    def logdir_path(self, timeinfo: str) -> str:
+        return f'log-{timeinfo}'
+
     def make_logdir(self, timeinfo: str) -> str:
-        logdir = f'log-{timeinfo}'
-        netutil.ensure_dir_exists(logdir)
+        logdir = self.logdir_path(timeinfo)
+        os.makedirs(logdir, exist_ok=True)
         return logdir
 
     def make_loginfo(self, timeinfo: str, **hinfo) -> str:
-        dir = self.make_logdir(timeinfo)
+        # the directory is created once per run by multi_connections
+        dir = self.logdir_path(timeinfo)
         loginfo = f'{dir}/{hinfo.get("host")}-{timeinfo}-JST.log'
         return loginfo
 
-    def rename_logfile(self, key: str, loginfo: str) -> None:
-        loginfo_renamed = loginfo.rstrip('.log') + f'-{key}.log'
-        os.rename(loginfo, loginfo_renamed)
+    def make_loginfos(self, timeinfo: str, hostlist: List[Dict[str, str]]) -> List[str]:
+        # a host listed more than once runs concurrently, so give every entry its own log file
+        seen: Dict[str, int] = {}
+        loginfos = []
+        for hinfo in hostlist:
+            loginfo = self.make_loginfo(timeinfo, **hinfo)
+            count = seen[loginfo] = seen.get(loginfo, 0) + 1
+            if count > 1:
+                loginfo = loginfo[:-len('.log')] + f'-{count}.log'
+            loginfos.append(loginfo)
+        return loginfos
+
+    def finalize_logfile(self, loginfo: str, key: str = None) -> None:
+        # the session log is written to a .part file and moved into place once the result is known
+        partfile = f'{loginfo}{PART_SUFFIX}'
+        if key:
+            loginfo = loginfo[:-len('.log')] + f'-{key}.log'
+        os.replace(partfile, loginfo)
 
     def ping_check(self, host: str) -> None:
         try:
@@ -105,76 +283,180 @@ class NetmikoOperator:
 
         except ping.errors.Timeout:
             error_msg = 'PingTimeout'
-            self.logger.error(f'{error_msg}: {host}')
+            self.logger.error('%s: %s', error_msg, host)
 
         except ping.errors.TimeToLiveExpired:
             error_msg = 'PingTTLExpired'
-            self.logger.error(f'{error_msg}: {host}')
+            self.logger.error('%s: %s', error_msg, host)
 
         except ping.errors.PingError:
             error_msg = 'PingUnreachable'
-            self.logger.error(f'{error_msg}: {host}')
+            self.logger.error('%s: %s', error_msg, host)
 
         except PermissionError:
             error_msg = 'PermissionError; OS requires root permission to send ICMP packets'
-            self.logger.error(f'{error_msg}')
+            self.logger.error(error_msg)
 
         except Exception as e:
-            self.logger.error(f'Error: {host}')
+            self.logger.error('Error: %s', host)
             self.logger.debug(e)
 
         else:
             success_msg = 'PingSuccess'
-            self.logger.info(f'{success_msg}: {host}')
+            self.logger.info('%s: %s', success_msg, host)
 
-    def wrapper_except_proccess(self, host: str, error_msg: str, loginfo: str) -> None:
-        self.ping_check(host)
-        self.logger.error(f'{error_msg}: {host}\n')
-        self.rename_logfile(error_msg, loginfo)
+    def is_reachable(self, host: str) -> bool:
+        # quiet counterpart of ping_check for the sweep, which only logs a summary
+        try:
+            ping.ping(host, timeout=0.5)
 
-    def multi_send_command(self, conn: Callable, commandlist: List[List[str]]) -> str:
-        conn.enable()
-        for command in commandlist:
-            print(f'{"="*30} {command[0]} @{conn.host} {"="*30}')
-            output = ''
-            output += conn.send_command(command[0], strip_prompt=False, strip_command=False) + '\n'
-            print(output)
-            print(f'{"="*80}\n')
-        return output
+        except ping.errors.PingError:
+            return False
 
-    def multi_connections(self, hostlist: List[Dict[str, str]], commandlist: List[List[str]]) -> None:
-        dt_now = dt.datetime.now(dt.timezone(dt.timedelta(hours=9)))
-        dt_now = dt_now.strftime('%Y%m%d-%H%M%S')
+        # reachability is unknown (e.g. no permission to send ICMP), so let SSH decide
+        except Exception as e:
+            self.logger.debug(e)
 
-        for hinfo in hostlist:
-            loginfo = self.make_loginfo(dt_now, **hinfo)
-            host = hinfo.get("host")
+        return True
+
+    def multiping(self, hosts: List[str], max_workers: int = MAX_WORKERS) -> Optional[Dict[str, bool]]:
+        # rows without a host would fail icmplib's whole batch; leave them to the ping3 sweep
+        if not all(hosts):
+            return None
 
+        # icmplib multiplexes every echo request over one socket; raw sockets need root,
+        # unprivileged ICMP sockets need net.ipv4.ping_group_range on Linux
+        for privileged in (True, False):
             try:
-                conn = self.connect_autodetect(hinfo, loginfo)
-                self.multi_send_command(conn, commandlist)
-                conn.disconnect()
+                results = icmplib.multiping(hosts, count=1, timeout=0.5,
+                                            concurrent_tasks=max_workers, privileged=privileged)
+            except icmplib.SocketPermissionError:
+                continue
+            # anything else (e.g. a name that doesn't resolve) goes to the per-host ping3 sweep
+            except Exception as e:
+                self.logger.debug(e)
+                return None
+            break
+        else:
+            return None
 
-            except netmiko.NetMikoAuthenticationException:
-                error_msg = 'SSHAuthenticationError'
-                self.wrapper_except_proccess(host, error_msg, loginfo)
+        return {host: result.is_alive for host, result in zip(hosts, results)}
 
-            except netmiko.NetMikoTimeoutException:
-                error_msg = 'SSHTimeoutError'
-                self.wrapper_except_proccess(host, error_msg, loginfo)
+    def ping_sweep(self, hosts: List[str], max_workers: int = MAX_WORKERS) -> Dict[str, bool]:
+        if icmplib:
+            alive = self.multiping(hosts, max_workers)
+            if alive is not None:
+                return alive
 
-            except netmiko.ReadTimeout:
-                error_msg = 'ReadTimeout or CommandMismatch'
-                self.wrapper_except_proccess(host, error_msg, loginfo)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts))) as executor:
+            return dict(zip(hosts, executor.map(self.is_reachable, hosts)))
+
+    def filter_reachable(self, hostlist: List[Dict[str, str]],
+                         max_workers: int = MAX_WORKERS) -> List[Dict[str, str]]:
+        alive = self.ping_sweep([hinfo.get("host") for hinfo in hostlist], max_workers)
+        unreachable = [host for host, ok in alive.items() if not ok]
+        if unreachable:
+            self.logger.error('Skipped unreachable hosts: %s\n', ', '.join(unreachable))
+        return [hinfo for hinfo in hostlist if alive[hinfo.get("host")]]
+
+    def wrapper_except_proccess(self, host: str, error_msg: str, loginfo: str) -> None:
+        # with the sweep on, the host already answered ping before we tried SSH
+        if not PING_BEFORE_CONNECT:
+            self.ping_check(host)
+        self.logger.error('%s: %s\n', error_msg, host)
+        self.finalize_logfile(loginfo, error_msg)
+
+    def multi_send_command(self, conn: Callable, commandlist: Tuple[str, ...]) -> None:
+        # outputs are not kept around; the session log already archives them
+        for command in commandlist:
+            output = conn.send_command(command, strip_prompt=False, strip_command=False)
+            # print each block at once so output of parallel hosts does not interleave
+            print(f'{RULER} {command} @{conn.host} {RULER}\n'
+                  f'{output}\n\n'
+                  f'{FOOTER}\n')
+
+    def single_connection(self, hinfo: Dict[str, str], loginfo: str, commandlist: Tuple[str, ...],
+                          keep_alive: bool = False) -> None:
+        host = hinfo.get("host")
+
+        try:
+            with open(f'{loginfo}{PART_SUFFIX}', 'wb') as session_log:
+                conn = self.get_connection(hinfo, session_log)
+                done = False
+                try:
+                    self.multi_send_command(conn, commandlist)
+                    done = True
+                finally:
+                    # a connection that failed mid-command is not worth keeping
+                    self.release_connection(host, conn, keep_alive and done)
+
+        except netmiko.NetMikoAuthenticationException:
+            error_msg = 'SSHAuthenticationError'
+            self.wrapper_except_proccess(host, error_msg, loginfo)
+
+        except netmiko.NetMikoTimeoutException:
+            error_msg = 'SSHTimeoutError'
+            self.wrapper_except_proccess(host, error_msg, loginfo)
+
+        except netmiko.ReadTimeout:
+            error_msg = 'ReadTimeout or CommandMismatch'
+            self.wrapper_except_proccess(host, error_msg, loginfo)
+
+        except Exception as e:
+            error_msg = 'Error'
+            self.wrapper_except_proccess(host, error_msg, loginfo)
+            self.logger.error(e)
+
+        else:
+            self.finalize_logfile(loginfo)
+            success_msg = 'SuccessfullyDone'
+            self.logger.info('%s: %s\n', success_msg, host)
+
+    def run_hosts(self, hostlist: List[Dict[str, str]], loginfos: List[str], commandlist: Tuple[str, ...],
+                  max_workers: int = MAX_WORKERS, keep_alive: bool = False) -> None:
+        # each host is I/O-bound on its SSH socket, so run them side by side
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(hostlist))) as executor:
+            # map releases each host's future once its result is consumed, instead of
+            # holding every future until the whole run is over
+            for _ in executor.map(self.single_connection, hostlist, loginfos,
+                                  repeat(commandlist), repeat(keep_alive)):
+                pass
+
+    def multi_connections(self, hostlist: List[Dict[str, str]], commandlist: Tuple[str, ...],
+                          max_workers: int = MAX_WORKERS, keep_alive: bool = False) -> None:
+        dt_now = dt.datetime.now(JST).strftime(TIME_FMT)
+
+        # don't wait for SSH timeouts on hosts that don't even answer ping
+        if PING_BEFORE_CONNECT and hostlist:
+            hostlist = self.filter_reachable(hostlist, max_workers)
+
+        if not hostlist:
+            return
+        # create the log directory up front so workers don't race on it
+        self.make_logdir(dt_now)
+        loginfos = self.make_loginfos(dt_now, hostlist)
+
+        # kept connections live in this process, so they can't be handed to worker processes
+        processes = min(os.cpu_count() or 1, max_workers, -(-len(hostlist) // max_workers))
+        if len(hostlist) <= PROCESS_THRESHOLD or processes < 2 or keep_alive:
+            self.run_hosts(hostlist, loginfos, commandlist, max_workers, keep_alive)
+            return
+
+        # spread SSH crypto work over several cores, each process with its own thread pool
+        # max_workers caps the whole run, so the processes split it between them
+        shards = [(hostlist[i::processes], loginfos[i::processes], commandlist,
+                   max(1, max_workers // processes))
+                  for i in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            pool.map(run_shard, shards)
+
+
+def run_shard(args: Tuple[List[Dict[str, str]], List[str], Tuple[str, ...], int]) -> None:
+    hostlist, loginfos, commandlist, max_workers = args
+    NetmikoOperator().run_hosts(hostlist, loginfos, commandlist, max_workers)
 
-            except Exception as e:
-                error_msg = 'Error'
-                self.wrapper_except_proccess(host, error_msg, loginfo)
-                self.logger.error(e)
 
-            else:
-                success_msg = 'SuccessfullyDone'
-                self.logger.info(f'{success_msg}: {host}\n')
+atexit.register(NetmikoOperator.close_all)
 
 
 def main():
@@ -183,7 +465,7 @@ def main():
     clist = csv_ope.read_commandlist()
 
     netmiko_ope = NetmikoOperator()
-    netmiko_ope.multi_connections(hlist, clist)
+    netmiko_ope.multi_connections(hlist, clist, keep_alive=KEEP_ALIVE)
 
 
 if __name__ == '__main__':